@@ -1,12 +1,20 @@
+import asyncio
+import json
 import logging
+import os
+import re
+import shutil
+import subprocess
+import uuid
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 from pathlib import Path
 from typing import List
 
+import aiofiles
 from fastapi import FastAPI, UploadFile, File, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
-
-from moviepy.editor import VideoFileClip
+from fastapi.responses import JSONResponse, FileResponse, Response
+from pydantic import BaseModel
 
 # ---------------------------------------------------------
 # Basisconfig
@@ -18,11 +26,97 @@ SPLIT_DIR = CLIPS_DIR / "split"
 CLIPS_DIR.mkdir(parents=True, exist_ok=True)
 SPLIT_DIR.mkdir(parents=True, exist_ok=True)
 
-logging.basicConfig(level=logging.INFO)
+# ffmpeg/ffprobe één keer opzoeken in PATH i.p.v. bij elke aanroep
+FFMPEG = shutil.which("ffmpeg") or "ffmpeg"
+FFPROBE = shutil.which("ffprobe") or "ffprobe"
+
+# precise-modus: aantal gelijktijdige ffmpeg-encodes en threads per encode,
+# zodat het totaal ongeveer op het aantal cores uitkomt
+CPU_COUNT = os.cpu_count() or 1
+CLIP_WORKERS = max(1, CPU_COUNT // 2)
+THREADS_PER_CLIP = max(1, CPU_COUNT // CLIP_WORKERS)
+# gedeeld over alle requests, zodat gelijktijdige uploads samen binnen het
+# budget blijven; ffmpeg draait in een eigen proces, dus threads volstaan
+CLIP_POOL = ThreadPoolExecutor(max_workers=CLIP_WORKERS)
+
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MB
+MAX_UPLOAD_BYTES = 300 * 1024 * 1024  # 300 MB
+ALLOWED_SUFFIXES = {".mp4", ".mov", ".mkv", ".webm"}
+
+# alles buiten [A-Za-z0-9_-.] wordt "_" (ook spaties en niet-ASCII tekens)
+_SAFE_FILENAME_CHARS = set(
+    b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-."
+)
+SAFE_FILENAME_TABLE = bytes(
+    c if c in _SAFE_FILENAME_CHARS else ord("_") for c in range(256)
+)
+
+# clipnamen bevatten een uuid per upload en worden nooit overschreven
+CLIP_RESPONSE_HEADERS = {"Cache-Control": "public, max-age=86400, immutable"}
+
+DURATION_RE = re.compile(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)")
+# codec en pixelformaat van de eerste videostream in de input-dump van ffmpeg,
+# bv. "Stream #0:0(und): Video: h264 (High) (avc1 / 0x31637661), yuv420p(tv, ...)"
+VIDEO_STREAM_RE = re.compile(r"Stream #0:\d+\S*: Video: (\w+)[^,]*, (\w+)")
+# alleen 8-bit 4:2:0 H.264 past zonder re-encode in een browser-afspeelbare mp4
+COPY_CODECS = {"h264"}
+COPY_PIX_FMTS = {"yuv420p", "yuvj420p"}
+
+# LOG_LEVEL mag een naam (DEBUG) of een getal (10) zijn; onbekend wordt INFO
+LOG_LEVEL = (os.environ.get("LOG_LEVEL") or "INFO").strip()
+_log_level = (
+    int(LOG_LEVEL) if LOG_LEVEL.isdigit() else logging.getLevelName(LOG_LEVEL.upper())
+)
+logging.basicConfig(level=_log_level if isinstance(_log_level, int) else logging.INFO)
 logger = logging.getLogger("motionforge")
+if not isinstance(_log_level, int):
+    logger.warning("Unknown LOG_LEVEL %r, falling back to INFO", LOG_LEVEL)
+
+
+class UploadSizeLimitMiddleware:
+    """Weiger te grote request-bodies met 413, vóór ze ingelezen worden.
+
+    Plain ASGI (geen BaseHTTPMiddleware), zodat responses zoals /download er
+    ongewijzigd doorheen gaan. Content-Length wordt vooraf gecontroleerd;
+    chunked uploads zonder Content-Length worden tijdens het ontvangen geteld.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.detail = f"File too large (max {max_bytes // (1024 * 1024)} MB)"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse({"detail": self.detail}, status_code=413)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # FastAPI laat HTTPExceptions uit het inlezen van de body
+                    # door, dus dit wordt gewoon een 413-response
+                    raise HTTPException(status_code=413, detail=self.detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
 
 app = FastAPI(title="MotionForge Backend")
 
+# vóór CORSMiddleware geregistreerd, zodat een 413 ook CORS-headers krijgt
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=MAX_UPLOAD_BYTES)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -36,104 +130,322 @@ app.add_middleware(
 # Helpers
 # ---------------------------------------------------------
 def safe_filename(original_name: str) -> str:
-    """Maak een veilige bestandsnaam"""
-    name = original_name.replace(" ", "_")
-    return "".join(c for c in name if c.isalnum() or c in ("_", "-", "."))
+    """Maak een veilige (ASCII-only) bestandsnaam"""
+    name = original_name.encode("ascii", "replace").translate(SAFE_FILENAME_TABLE)
+    return name.decode("ascii")
+
+
+def get_video_duration(input_path: Path) -> float:
+    """Lees de duur (in seconden) van de eerste videostream via ffprobe."""
+    cmd = [
+        FFPROBE, "-v", "error",
+        "-analyzeduration", "100000",
+        "-probesize", "100000",
+        "-select_streams", "v:0",
+        "-show_entries", "stream=duration:format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        str(input_path),
+    ]
+    result = subprocess.run(
+        cmd, stdin=subprocess.DEVNULL, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe failed: {result.stderr.strip()}")
+
+    # stream-duur eerst; sommige containers (mkv/webm) hebben alleen format-duur
+    for line in result.stdout.split():
+        try:
+            return float(line)
+        except ValueError:
+            continue
+    return 0.0
+
+
+def parse_duration(ffmpeg_output: str) -> float:
+    """Haal de duur uit de "Duration: HH:MM:SS.ms"-regel van ffmpeg."""
+    match = DURATION_RE.search(ffmpeg_output)
+    if not match:
+        return 0.0
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def cut_clip(input_path: Path, start: float, end: float, output_path: Path) -> None:
+    """Knip één clip frame-nauwkeurig (re-encode, -ss vóór -i voor snelle seek)."""
+    cmd = [
+        FFMPEG, "-nostdin", "-y",
+        "-ss", f"{start:.3f}",
+        "-i", str(input_path),
+        "-t", f"{end - start:.3f}",
+        "-c:v", "libx264",
+        "-preset", "ultrafast",
+        "-pix_fmt", "yuv420p",
+        "-threads", str(THREADS_PER_CLIP),
+        "-an",
+        str(output_path),
+    ]
+    result = subprocess.run(
+        cmd, stdin=subprocess.DEVNULL, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        logger.error(result.stderr)
+        raise RuntimeError(f"ffmpeg failed with exit code {result.returncode}")
+
+
+class StreamCopyUnsupported(RuntimeError):
+    """De videostream past niet zonder re-encode in een afspeelbare mp4."""
+
 
+def remove_clips(stem: str) -> None:
+    """Verwijder alle clips van één upload uit de split-map."""
+    for path in SPLIT_DIR.glob(f"clip_{stem}_*.mp4"):
+        path.unlink(missing_ok=True)
 
-def split_video(input_path: Path, clip_length: int) -> List[str]:
-    """Split video in clips van N seconden, zonder audio (stabieler op Railway)."""
-    logger.info(f"Start splitting: {input_path} in chunks of {clip_length}s")
+
+async def split_video(
+    input_path: Path, clip_length: int, precise: bool = False
+) -> List[str]:
+    """Split video in clips van N seconden, zonder audio (stabieler op Railway).
+
+    Geeft de clipnamen (clip_<stem>_<n>.mp4) op volgorde terug.
+
+    Standaard één ffmpeg-run met de segment-muxer: stream copy, dus geen
+    decode/encode. Clips worden dan op keyframes geknipt en kunnen iets
+    afwijken van N. Met precise=True, of als de input geen 8-bit 4:2:0 H.264
+    is en dus niet zonder re-encode in een afspeelbare mp4 past, wordt elke
+    clip exact geknipt en opnieuw ge-encodeerd.
+    """
+    logger.info("Start splitting: %s in chunks of %ds", input_path, clip_length)
 
     if not input_path.exists():
         raise RuntimeError(f"Input file not found: {input_path}")
 
-    try:
-        video = VideoFileClip(str(input_path), audio=False)
-    except Exception as e:
-        raise RuntimeError(f"Failed to open video: {e}")
+    if not precise:
+        try:
+            return await _split_copy(input_path, clip_length)
+        except StreamCopyUnsupported as e:
+            logger.info("Stream copy not possible (%s), re-encoding instead", e)
 
-    duration = float(video.duration or 0)
+    return await _split_reencode(input_path, clip_length)
+
+
+async def _split_reencode(input_path: Path, clip_length: int) -> List[str]:
+    """Knip elke clip apart en exact, met de encodes parallel op CLIP_POOL."""
+    # hier is de duur vooraf nodig om de knippunten te bepalen
+    duration = await asyncio.to_thread(get_video_duration, input_path)
     if duration <= 0:
-        video.close()
         raise RuntimeError("Invalid video duration")
+    logger.info("Duration: %.2fs", duration)
 
-    clips_created = []
+    jobs = []
     start = 0.0
     index = 1
+    while start < duration:
+        end = min(start + clip_length, duration)
+        logger.debug("Clip %d: %.2fs → %.2fs", index, start, end)
+        jobs.append((start, end, f"clip_{input_path.stem}_{index}.mp4"))
+        start = end
+        index += 1
+
+    futures = [
+        CLIP_POOL.submit(cut_clip, input_path, start, end, SPLIT_DIR / name)
+        for start, end, name in jobs
+    ]
+    _, pending = await asyncio.to_thread(wait, futures, return_when=FIRST_EXCEPTION)
+    if pending:
+        # een encode is mislukt: nog niet gestarte encodes annuleren en op de
+        # lopende wachten, zodat er na het opruimen geen clips meer bijkomen
+        running = [f for f in pending if not f.cancel()]
+        if running:
+            await asyncio.to_thread(wait, running)
+    for future in futures:
+        if not future.cancelled():
+            future.result()
+
+    clips_created = [name for _, _, name in jobs]
+    logger.info("Created %d clips", len(clips_created))
+    return clips_created
+
+
+async def _split_copy(input_path: Path, clip_length: int) -> List[str]:
+    """Split met één stream-copy run van de segment-muxer.
+
+    Gooit StreamCopyUnsupported als de input geen 8-bit 4:2:0 H.264 is; elke
+    andere mislukte run geeft een RuntimeError met de foutregel van ffmpeg.
+    """
+    cmd = [
+        FFMPEG, "-nostdin", "-y",
+        "-i", str(input_path),
+        "-map", "0:v:0",
+        "-an",
+        "-c", "copy",
+        "-f", "segment",
+        "-segment_time", str(clip_length),
+        "-reset_timestamps", "1",
+        "-segment_start_number", "1",
+        str(SPLIT_DIR / f"clip_{input_path.stem}_%d.mp4"),
+    ]
+
+    # ffmpeg als asyncio-subprocess: het wachten kost geen worker-thread
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
 
-    try:
-        while start < duration:
-            end = min(start + clip_length, duration)
-            logger.info(f"Clip {index}: {start:.2f}s → {end:.2f}s")
+    # ffmpeg print de input-streams voordat er een clip geschreven wordt;
+    # lees die header tot codec en pixelformaat van de video bekend zijn
+    header = []
+    match = None
+    while match is None:
+        line = await proc.stderr.readline()
+        if not line:
+            break
+        text = line.decode("utf-8", "replace")
+        header.append(text)
+        match = VIDEO_STREAM_RE.search(text)
+
+    if match is not None:
+        codec, pix_fmt = match.groups()
+        if codec not in COPY_CODECS or pix_fmt not in COPY_PIX_FMTS:
+            proc.kill()
+            await proc.wait()
+            remove_clips(input_path.stem)
+            raise StreamCopyUnsupported(f"video {codec}/{pix_fmt}")
+
+    _, stderr_bytes = await proc.communicate()
+    stderr = "".join(header) + stderr_bytes.decode("utf-8", "replace")
+
+    if proc.returncode != 0:
+        logger.error(stderr)
+        # laatste regel van ffmpeg is meestal de echte oorzaak
+        lines = stderr.strip().splitlines()
+        reason = lines[-1] if lines else "no output"
+        raise RuntimeError(
+            f"ffmpeg failed with exit code {proc.returncode}: {reason}"
+        )
+
+    clips_created = sorted(
+        (p.name for p in SPLIT_DIR.glob(f"clip_{input_path.stem}_*.mp4")),
+        key=lambda name: int(name.rsplit("_", 1)[1][:-4]),
+    )
+    if not clips_created:
+        logger.error(stderr)
+        raise RuntimeError("ffmpeg produced no clips (invalid video?)")
 
-            subclip = video.subclip(start, end)
-            output_name = f"{input_path.stem}_part{index}.mp4"
-            output_path = SPLIT_DIR / output_name
+    # de segment-muxer heeft geen duur vooraf nodig; ffmpeg logt hem toch
+    # (live-achtige bronnen melden "N/A", dan valideren we op de clips zelf)
+    duration = parse_duration(stderr)
+    if duration > 0:
+        logger.info("Duration: %.2fs", duration)
 
-            subclip.write_videofile(
-                str(output_path),
-                codec="libx264",
-                audio=False,
-                remove_temp=True,
-                logger=None,
-            )
+    logger.info("Created %d clips", len(clips_created))
+    return clips_created
 
-            clips_created.append(output_name)
-            start = end
-            index += 1
 
-        video.close()
-        return clips_created
+# cache voor /clips; alleen opnieuw scannen als de map gewijzigd is
+_split_clips_cache = {"mtime": None, "clips": []}
 
-    except Exception as e:
-        video.close()
-        logger.exception("Error during splitting")
-        raise RuntimeError(f"Error while splitting video: {e}")
+
+def list_split_clips() -> List[str]:
+    """Namen van alle clips in de split-map, gecached op de mtime van de map."""
+    mtime = SPLIT_DIR.stat().st_mtime_ns
+    if mtime != _split_clips_cache["mtime"]:
+        with os.scandir(SPLIT_DIR) as entries:
+            _split_clips_cache["clips"] = [
+                entry.name for entry in entries if entry.name.endswith(".mp4")
+            ]
+        _split_clips_cache["mtime"] = mtime
+    return _split_clips_cache["clips"]
+
+
+# ---------------------------------------------------------
+# Response models
+# ---------------------------------------------------------
+# met een return type serialiseert FastAPI direct via Pydantic naar JSON-bytes
+class UploadResult(BaseModel):
+    status: str
+    message: str
+    id: str
+    original: str
+    clips: List[str]
+
+
+class ClipList(BaseModel):
+    count: int
+    clips: List[str]
 
 
 # ---------------------------------------------------------
 # Routes
 # ---------------------------------------------------------
+# vaste body, één keer geserialiseerd bij het laden van de module
+ROOT_BODY = json.dumps(
+    {"status": "ok", "message": "MotionForge backend running"}
+).encode("utf-8")
+
+
 @app.get("/")
 async def root():
-    return {"status": "ok", "message": "MotionForge backend running"}
+    return Response(content=ROOT_BODY, media_type="application/json")
 
 
 @app.post("/upload")
 async def upload_video(
     file: UploadFile = File(...),
     clip_length: int = Query(4, description="Length of each clip in seconds"),
-):
-    logger.info(f"Received upload: {file.filename} (clip_length={clip_length})")
+    precise: bool = Query(False, description="Re-encode for frame-accurate cuts"),
+) -> UploadResult:
+    logger.info("Received upload: %s (clip_length=%d)", file.filename, clip_length)
 
     if clip_length <= 0:
         raise HTTPException(status_code=400, detail="clip_length must be > 0")
 
+    # opslaan onder een uuid: geen botsingen tussen gelijktijdige uploads met
+    # dezelfde naam en geen paden uit de client-bestandsnaam
+    suffix = Path(file.filename or "").suffix.lower()
+    if suffix not in ALLOWED_SUFFIXES:
+        raise HTTPException(
+            status_code=415,
+            detail=(
+                "Unsupported file type "
+                f"(allowed: {', '.join(sorted(ALLOWED_SUFFIXES))})"
+            ),
+        )
+
     try:
-        filename = safe_filename(file.filename or "input.mp4")
-        input_path = CLIPS_DIR / filename
+        file_id = uuid.uuid4().hex
+        filename = safe_filename(file.filename)
+        input_path = CLIPS_DIR / f"{file_id}{suffix}"
 
-        # bestand wegschrijven
-        with input_path.open("wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+        # bestand in chunks wegschrijven, zonder alles in geheugen te laden
+        # (de maximale grootte bewaakt UploadSizeLimitMiddleware al)
+        size = 0
+        async with aiofiles.open(input_path, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await buffer.write(chunk)
+                size += len(chunk)
 
-        logger.info(f"Saved to {input_path} ({len(content)} bytes)")
+        logger.info("Saved to %s (%d bytes)", input_path, size)
 
         # splitten
         try:
-            clips = split_video(input_path, clip_length)
+            clips = await split_video(input_path, clip_length, precise)
         except Exception as e:
             logger.exception("Split error")
+            # ffmpeg is dan al klaar of gestopt; halve resultaten opruimen
+            remove_clips(file_id)
+            input_path.unlink(missing_ok=True)
             raise HTTPException(status_code=500, detail=f"Split error: {e}")
 
-        return JSONResponse({
-            "status": "ok",
-            "message": "Video split successfully",
-            "original": filename,
-            "clips": clips,
-        })
+        return UploadResult(
+            status="ok",
+            message="Video split successfully",
+            id=file_id,
+            original=filename,
+            clips=clips,
+        )
 
     except HTTPException:
         raise
@@ -143,10 +455,10 @@ async def upload_video(
 
 
 @app.get("/clips")
-async def list_clips():
+async def list_clips() -> ClipList:
     """Toon alle clips in de split-map."""
-    files = [f.name for f in SPLIT_DIR.glob("*.mp4")]
-    return {"count": len(files), "clips": files}
+    files = list_split_clips()
+    return ClipList(count=len(files), clips=files)
 
 
 # ---------------------------------------------------------
@@ -160,8 +472,10 @@ async def download_clip(filename: str):
     if not file_path.exists():
         raise HTTPException(status_code=404, detail="File not found")
 
+    # FileResponse levert zelf ETag/Last-Modified, Accept-Ranges en Range-requests
     return FileResponse(
         path=str(file_path),
         media_type="video/mp4",
         filename=filename,
+        headers=CLIP_RESPONSE_HEADERS,
     )